@@ -3,6 +3,13 @@
 import requests
 import os
 import json
+import time
+import heapq
+import itertools
+import argparse
+import gzip
+import signal
+from datetime import datetime
 from requests.auth import HTTPBasicAuth
 from dotenv import load_dotenv
 from jira import JIRA
@@ -27,32 +34,95 @@ GITHUB_PROJECT_OWNER = os.getenv("GITHUB_PROJECT_OWNER")
 GITHUB_PROJECT_NAME = os.getenv("GITHUB_PROJECT_NAME")
 GITHUB_PROJECT_NUMBER = os.getenv("GITHUB_PROJECT_NUMBER")
 
-
-def fetch_jira_issues(jql_query=f"project={JIRA_PROJECT_NAME}"):
+# Jira custom field holding the sprints of an issue
+JIRA_SPRINT_FIELD = os.getenv("JIRA_SPRINT_FIELD", "customfield_10020")
+
+# Daemon mode settings (in seconds)
+DAEMON_MIN_INTERVAL = float(os.getenv("DAEMON_MIN_INTERVAL", "5"))
+DAEMON_MAX_INTERVAL = float(os.getenv("DAEMON_MAX_INTERVAL", "300"))
+DAEMON_FULL_SYNC_INTERVAL = float(os.getenv("DAEMON_FULL_SYNC_INTERVAL", "3600"))
+DAEMON_HOT_WINDOW = float(os.getenv("DAEMON_HOT_WINDOW", "86400"))
+DAEMON_SAVE_INTERVAL = float(os.getenv("DAEMON_SAVE_INTERVAL", "30"))
+# Stop sending requests to GitHub when fewer than this many are left
+GITHUB_RATE_LIMIT_THRESHOLD = int(os.getenv("GITHUB_RATE_LIMIT_THRESHOLD", "100"))
+
+# What to do with the Github issues of removed Jira issues: archive, close or both
+RECONCILE_ACTIONS = ("archive", "close", "both")
+RECONCILE_ACTION = os.getenv("RECONCILE_ACTION", "archive").strip().lower()
+RECONCILE_BATCH_SIZE = int(os.getenv("RECONCILE_BATCH_SIZE", "50"))
+
+# Used for the labels created without prompting (daemon mode)
+DEFAULT_LABEL_COLOR = os.getenv("DEFAULT_LABEL_COLOR", "ededed")
+DEFAULT_LABEL_DESCRIPTION = os.getenv("DEFAULT_LABEL_DESCRIPTION", "Replicated from Jira")
+
+SNAPSHOT_FILE = "jira_snapshot.ndjson.gz"
+JIRA_SAVE_FILE = "jira_save.json"
+GITHUB_SAVE_FILE = "github_save.json"
+
+# Shared between calls (and daemon cycles) to keep connections and lookups warm
+HTTP_SESSION = requests.Session()
+GITHUB_RATE_LIMIT = {"remaining": None, "reset": None}
+JIRA_CLIENT = {}
+REPOSITORY_ID_CACHE = {}
+USER_NODE_ID_CACHE = {}
+PROJECT_DETAILS_CACHE = {}
+EXISTING_LABELS = set()
+
+
+def track_rate_limit(response):
+    remaining = response.headers.get("X-RateLimit-Remaining")
+    reset = response.headers.get("X-RateLimit-Reset")
+    if remaining is not None:
+        GITHUB_RATE_LIMIT["remaining"] = int(remaining)
+    if reset is not None:
+        GITHUB_RATE_LIMIT["reset"] = int(reset)
+
+
+def rate_limit_wait_time():
+    remaining = GITHUB_RATE_LIMIT["remaining"]
+    reset = GITHUB_RATE_LIMIT["reset"]
+    if remaining is None or reset is None or remaining >= GITHUB_RATE_LIMIT_THRESHOLD:
+        return 0
+    return max(0, reset - time.time())
+
+
+def get_jira_client():
+    if "client" not in JIRA_CLIENT:
+        JIRA_CLIENT["client"] = JIRA(server=JIRA_BASE_URL, basic_auth=(JIRA_USER, JIRA_API_TOKEN))
+    return JIRA_CLIENT["client"]
+
+
+def iter_jira_issues(jql_query=f"project={JIRA_PROJECT_NAME}"):
     headers = {"Accept": "application/json"}
-    params = {"jql": jql_query, "maxResults": 100}
-    response = requests.get(
-        JIRA_API_ENDPOINT,
-        headers=headers,
-        params=params,
-        auth=HTTPBasicAuth(JIRA_USER, JIRA_API_TOKEN),
-    )
-    response.raise_for_status()
-    issues = response.json()["issues"]
+    start_at = 0
+    while True:
+        params = {"jql": jql_query, "startAt": start_at, "maxResults": 100}
+        response = HTTP_SESSION.get(
+            JIRA_API_ENDPOINT,
+            headers=headers,
+            params=params,
+            auth=HTTPBasicAuth(JIRA_USER, JIRA_API_TOKEN),
+        )
+        response.raise_for_status()
+        page = response.json()
+        yield from page["issues"]
+        start_at += len(page["issues"])
+        if not page["issues"] or start_at >= page["total"]:
+            break
 
-    sprints = []
+
+def iter_jira_sprints():
     start_at = 0
     max_results = 50  # Jira default page size for sprints
 
-    jira_instance = JIRA(server=JIRA_BASE_URL, basic_auth=(JIRA_USER, JIRA_API_TOKEN))
+    jira_instance = get_jira_client()
 
     board_id = int(JIRA_BOARD_ID)
-    sprints_page = jira_instance.sprints(
-        board_id, startAt=start_at, maxResults=max_results, state="active,closed,future"
-    )
     while True:
         # Retrieve a page of sprints
-
+        sprints_page = jira_instance.sprints(
+            board_id, startAt=start_at, maxResults=max_results, state="active,closed,future"
+        )
         if not sprints_page:
             break
         for sprint in sprints_page:
@@ -64,13 +134,84 @@ def fetch_jira_issues(jql_query=f"project={JIRA_PROJECT_NAME}"):
                 "endDate": getattr(sprint, "endDate", None),
                 "state": getattr(sprint, "state", None)
             }
-            sprints.append(detail)
+            yield detail
 
         if len(sprints_page) < max_results:
             break
         start_at += max_results
 
-    return {"issues": issues, "sprints": sprints}
+
+def fetch_jira_issues(jql_query=f"project={JIRA_PROJECT_NAME}"):
+    return {"issues": list(iter_jira_issues(jql_query)), "sprints": list(iter_jira_sprints())}
+
+
+def write_snapshot(snapshot_file=SNAPSHOT_FILE):
+    issues_count = 0
+    # Only replace the snapshot once Jira has sent everything
+    try:
+        with gzip.open(f"{snapshot_file}.tmp", "wt", encoding="utf-8") as file:
+            # Sprints first so they are known before the issues when reading the snapshot back
+            for sprint in iter_jira_sprints():
+                file.write(json.dumps({"sprint": sprint}) + "\n")
+            for issue in iter_jira_issues():
+                file.write(json.dumps({"issue": issue}) + "\n")
+                issues_count += 1
+            file.write(json.dumps({"end": {"issues": issues_count}}) + "\n")
+    except BaseException:
+        # gzip.open itself may have failed, don't hide its error behind the cleanup
+        if os.path.exists(f"{snapshot_file}.tmp"):
+            os.remove(f"{snapshot_file}.tmp")
+        raise
+    os.replace(f"{snapshot_file}.tmp", snapshot_file)
+    print(f"Saved {issues_count} Jira issue(s) to {snapshot_file}")
+
+
+def iter_snapshot(snapshot_file=SNAPSHOT_FILE):
+    issues_count = 0
+    with gzip.open(snapshot_file, "rt", encoding="utf-8") as file:
+        for line in file:
+            record = json.loads(line)
+            if "end" in record:
+                if record["end"]["issues"] != issues_count:
+                    break
+                return
+            if "issue" in record:
+                issues_count += 1
+            yield record
+    raise ValueError(f"The snapshot {snapshot_file} is incomplete, take a new one")
+
+
+def read_snapshot(snapshot_file=SNAPSHOT_FILE):
+    # The sprints are few and needed by every issue, the issues are streamed from the file
+    records = iter_snapshot(snapshot_file)
+    sprints = []
+    for record in records:
+        if "sprint" not in record:
+            return sprints, itertools.chain([record["issue"]], (record["issue"] for record in records))
+        sprints.append(record["sprint"])
+    return sprints, iter(())
+
+
+def fetch_jira_issue_ids(jql_query=f"project={JIRA_PROJECT_NAME}"):
+    headers = {"Accept": "application/json"}
+    issue_ids = set()
+    start_at = 0
+    while True:
+        # Only ask for the ids, the pages stay small even on big projects
+        params = {"jql": jql_query, "fields": "id", "startAt": start_at, "maxResults": 1000}
+        response = HTTP_SESSION.get(
+            JIRA_API_ENDPOINT,
+            headers=headers,
+            params=params,
+            auth=HTTPBasicAuth(JIRA_USER, JIRA_API_TOKEN),
+        )
+        response.raise_for_status()
+        page = response.json()
+        issue_ids.update(issue["id"] for issue in page["issues"])
+        start_at += len(page["issues"])
+        if not page["issues"] or start_at >= page["total"]:
+            break
+    return issue_ids
 
 
 def create_repository_issue(title, body, repo_id):
@@ -120,6 +261,8 @@ def add_issue_to_project(issue_node_id):
 
 
 def get_repository_id(owner, repository):
+    if (owner, repository) in REPOSITORY_ID_CACHE:
+        return REPOSITORY_ID_CACHE[(owner, repository)]
 
     url = "https://api.github.com/graphql"
     query = """
@@ -137,10 +280,12 @@ def get_repository_id(owner, repository):
 
     payload = {"query": query}
 
-    response = requests.post(url, headers=headers, json=payload)
+    response = HTTP_SESSION.post(url, headers=headers, json=payload)
+    track_rate_limit(response)
     response.raise_for_status()
     data = response.json()
-    return data["data"]["repository"]["id"]
+    REPOSITORY_ID_CACHE[(owner, repository)] = data["data"]["repository"]["id"]
+    return REPOSITORY_ID_CACHE[(owner, repository)]
 
 
 def create_issue_on_board(title, body):
@@ -151,6 +296,8 @@ def create_issue_on_board(title, body):
 
 
 def get_project_details():
+    if "details" in PROJECT_DETAILS_CACHE:
+        return PROJECT_DETAILS_CACHE["details"]
     url = "https://api.github.com/graphql"
     headers = {
         "Authorization": f"bearer {GITHUB_TOKEN}",
@@ -195,9 +342,11 @@ def get_project_details():
     }}
     """
     payload = {"query": query}
-    response = requests.post(url, headers=headers, json=payload)
+    response = HTTP_SESSION.post(url, headers=headers, json=payload)
+    track_rate_limit(response)
     response.raise_for_status()
-    return response.json()
+    PROJECT_DETAILS_CACHE["details"] = response.json()
+    return PROJECT_DETAILS_CACHE["details"]
 
 
 def run_graphql(query, variables):
@@ -207,8 +356,9 @@ def run_graphql(query, variables):
         "Content-Type": "application/json",
         "Accept": "application/vnd.github.starfox-preview+json"
     }
-    response = requests.post(url, json={
+    response = HTTP_SESSION.post(url, json={
         "query": query, "variables": variables}, headers=headers)
+    track_rate_limit(response)
     response.raise_for_status()
     return response.json()
 
@@ -245,21 +395,28 @@ def add_assignees_to_issue(assignable_id, assignee_ids):
         "Content-Type": "application/json",
         "Accept": "application/vnd.github.starfox-preview+json"
     }
-    response = requests.post(url, headers=headers, json={
+    response = HTTP_SESSION.post(url, headers=headers, json={
         "query": query, "variables": variables})
+    track_rate_limit(response)
     response.raise_for_status()
     return response.json()
 
 
 def label_exists(label_name):
+    if label_name in EXISTING_LABELS:
+        return True
 
     url = f"https://api.github.com/repos/{GITHUB_PROJECT_OWNER}/{GITHUB_PROJECT_NAME}/labels/{label_name}"
     headers = {
         "Authorization": f"Bearer {GITHUB_TOKEN}",
         "Accept": "application/vnd.github+json"
     }
-    response = requests.get(url, headers=headers)
-    return response.status_code == 200
+    response = HTTP_SESSION.get(url, headers=headers)
+    track_rate_limit(response)
+    if response.status_code == 200:
+        EXISTING_LABELS.add(label_name)
+        return True
+    return False
 
 
 def create_label(label_name, color, description):
@@ -275,16 +432,22 @@ def create_label(label_name, color, description):
         "color": color,
         "description": description
     }
-    response = requests.post(url, headers=headers, json=data)
+    response = HTTP_SESSION.post(url, headers=headers, json=data)
+    track_rate_limit(response)
     response.raise_for_status()
+    EXISTING_LABELS.add(label_name)
     return response.json()
 
 
-def create_label_if_not_exists(labels_name):
+def create_label_if_not_exists(labels_name, interactive=True):
 
     for label in labels_name:
         if label_exists(label):
             print(f"Label '{label}' already exists.")
+        elif not interactive:
+            # Nobody to answer the prompts, the colour can still be changed on Github later
+            print(f"Label '{label}' not found. Creating it with the default color...")
+            create_label(label, DEFAULT_LABEL_COLOR, DEFAULT_LABEL_DESCRIPTION)
         else:
             print(f"Label '{label}' not found. Creating it...")
             color = input(f"Enter the color for the label in the following format (#eb0dbc) '{label}': ")
@@ -298,7 +461,8 @@ def add_labels_to_issue(issue_number, labels):
         "Authorization": f"Bearer {GITHUB_TOKEN}",
         "Accept": "application/vnd.github+json"
     }
-    response = requests.post(url, headers=headers, json=labels)
+    response = HTTP_SESSION.post(url, headers=headers, json=labels)
+    track_rate_limit(response)
     response.raise_for_status()
     return response.json()
 
@@ -409,6 +573,8 @@ def update_infos(issue_node_id, side_infos_dict, items_id, user_id, issue_id, is
 
 
 def get_user_node_id(username):
+    if username in USER_NODE_ID_CACHE:
+        return USER_NODE_ID_CACHE[username]
     url = "https://api.github.com/graphql"
     query = """
     query GetUserId($login: String!) {
@@ -422,11 +588,13 @@ def get_user_node_id(username):
         "Authorization": f"bearer {GITHUB_TOKEN}",
         "Content-Type": "application/json"
     }
-    response = requests.post(url, json={
+    response = HTTP_SESSION.post(url, json={
         "query": query, "variables": variables}, headers=headers)
+    track_rate_limit(response)
     response.raise_for_status()
     data = response.json()
-    return data["data"]["user"]["id"]
+    USER_NODE_ID_CACHE[username] = data["data"]["user"]["id"]
+    return USER_NODE_ID_CACHE[username]
 
 
 def get_github_issue(issue_number):
@@ -435,7 +603,8 @@ def get_github_issue(issue_number):
         "Authorization": f"Bearer {GITHUB_TOKEN}",
         "Accept": "application/vnd.github.v3+json"
     }
-    response = requests.get(url, headers=headers)
+    response = HTTP_SESSION.get(url, headers=headers)
+    track_rate_limit(response)
     if response.status_code == 200:
         return response.json()
     else:
@@ -516,6 +685,8 @@ def create_iteration_field(fields_name, creation_date):
     }
     result = run_graphql(mutation, variables)
     created_field = result["data"]["createProjectV2Field"]["projectV2Field"]
+    # The project now has a Sprint field, refetch the details next time
+    PROJECT_DETAILS_CACHE.clear()
     return created_field
 
 
@@ -563,6 +734,11 @@ def is_same_infos(jira_saved_infos, actual_issue, sprints):
                 "side_infos": side_infos_dict,
                 },
         }
+    # The created sprint is only known once replicated, leave it out of the comparison
+    jira_saved_infos = {
+        "id": jira_saved_infos["id"],
+        "infos": {key: value for key, value in jira_saved_infos["infos"].items() if key != "created_sprint"},
+    }
     added, removed, modified, same = dict_compare(jira_saved_infos, jira_new_infos)
     if "infos" and "id" in same:
         issue_exist = True
@@ -574,144 +750,431 @@ def is_same_infos(jira_saved_infos, actual_issue, sprints):
     return {"id": jira_saved_infos["id"], "existing": issue_exist, "modified": issue_modified, "added": issue_added}
 
 
-def find_issue_to_update(fetched_values):
+def find_issue_to_update(fetched_values, jira_saves):
     final_infos = []
-    try:
-        jira_saved_infos = open("jira_save.json", "r")
-    except FileNotFoundError:
-        for issue in fetched_values["issues"]:
-            fields = issue.get("fields", {})
-            final_infos.append({"id": fields.get("id"), "existing": False})
-        return final_infos
-    jira_saved_infos_dict = json.load(jira_saved_infos)
-    i = 0
     for issue in fetched_values["issues"]:
-        final_infos.append(is_same_infos(jira_saved_infos_dict[i], issue, fetched_values["sprints"]))
-        i += 1
+        jira_saved_infos = jira_saves.get(issue.get("id"))
+        if jira_saved_infos is None:
+            final_infos.append({"id": issue.get("id"), "existing": False})
+        else:
+            final_infos.append(is_same_infos(jira_saved_infos, issue, fetched_values["sprints"]))
     return final_infos
 
 
-def corresponding_jira_issue(jira_issue_number, list_of_infos):
-    for issue in list_of_infos:
-        if jira_issue_number == issue["id"]:
-            return issue
-
-
-def get_linked_github_issue(actual_jira_issue_number):
-    github_save = open("github_save.json", "r")
-    github_saved_infos = json.load(github_save)
-    for issue in github_saved_infos:
-        if issue["linked_jira_issue_number"] == actual_jira_issue_number:
-            return issue
-
+def load_saves():
+    saves = []
+    for save_file in (JIRA_SAVE_FILE, GITHUB_SAVE_FILE):
+        try:
+            with open(save_file, "r") as file:
+                saves.append(json.load(file))
+        except FileNotFoundError:
+            saves.append([])
+    jira_saved_infos, github_saved_infos = saves
+
+    jira_saves = {infos["id"]: infos for infos in jira_saved_infos if infos["id"] is not None}
+    github_saves = {infos["linked_jira_issue_number"]: infos for infos in github_saved_infos
+                    if infos["linked_jira_issue_number"] is not None}
+    # Older saves were written without the Jira id, they are matched by position with adopt_legacy_saves
+    return jira_saves, github_saves, (jira_saved_infos, github_saved_infos)
+
+
+def adopt_legacy_saves(position, issue, legacy_saves, jira_saves, github_saves):
+    jira_saved_infos, github_saved_infos = legacy_saves
+    if position < len(jira_saved_infos) and jira_saved_infos[position]["id"] is None:
+        jira_saved_infos[position]["id"] = issue.get("id")
+        jira_saves[issue.get("id")] = jira_saved_infos[position]
+    if position < len(github_saved_infos) and github_saved_infos[position]["linked_jira_issue_number"] is None:
+        github_saved_infos[position]["linked_jira_issue_number"] = issue.get("id")
+        github_saves[issue.get("id")] = github_saved_infos[position]
+
+
+def write_saves(jira_saves, github_saves, legacy_saves=None):
+    jira_saved_infos, github_saved_infos = legacy_saves or ([], [])
+    for save_file, saves, saved_infos, key in (
+            (JIRA_SAVE_FILE, jira_saves, jira_saved_infos, "id"),
+            (GITHUB_SAVE_FILE, github_saves, github_saved_infos, "linked_jira_issue_number")):
+        # Older saves not adopted yet keep their position, the next run still matches them
+        entries = []
+        written_ids = set()
+        for infos in saved_infos:
+            if infos[key] is None:
+                entries.append(infos)
+            elif infos[key] in saves and infos[key] not in written_ids:
+                entries.append(saves[infos[key]])
+                written_ids.add(infos[key])
+        entries.extend(infos for issue_id, infos in saves.items() if issue_id not in written_ids)
+
+        # Write next to the save and swap, an interrupted write never leaves a truncated save
+        with open(f"{save_file}.tmp", "w") as file:
+            json.dump(entries, file)
+        os.replace(f"{save_file}.tmp", save_file)
+
+
+def replicate_issue(issue, sprints, jira_saves, github_saves, interactive=True):
+    fields = issue.get("fields", {})
+    jira_issue_id = issue.get("id")
+
+    # Basic fields
+    column = fields.get("status", {}).get("name", "Not set")
+    title = fields.get("summary", "No summary provided")
+    description = fields.get("description", "No description provided")
+    # jira_url = f"{JIRA_BASE_URL}/browse/{issue['key']}"
 
-def replicate_jira_to_github():
-    saved_infos = []
-    jira_issues_infos = []
-    fetched_values = fetch_jira_issues()
+    start_date = fields.get("customfield_10015", "Not set")
+    due_date = fields.get("duedate", "Not set")
+    story_points = fields.get("customfield_10016", "Not set")
+    creation_date = fields.get("created", "Not Set").split("T")[0]
+    assignee = fields.get("assignee", {})
+    assignee_name = assignee.get("displayName", "Unassigned")
+    labels = fields.get("labels", [])
+    labels_str = ", ".join(labels) if labels else "None"
+    # priority = fields.get("priority", {}).get("name", "Not set")
 
-    list_of_infos = find_issue_to_update(fetched_values)
+    # parent = fields.get("parent")
+    # parent_info = parent.get("key") if parent else "No parent"
 
-    for issue in fetched_values["issues"]:
-        fields = issue.get("fields", {})
-        dict_of_infos = corresponding_jira_issue(fields.get("id"), list_of_infos)
-
-        # Basic fields
-        column = fields.get("status", {}).get("name", "Not set")
-        title = fields.get("summary", "No summary provided")
-        description = fields.get("description", "No description provided")
-        # jira_url = f"{JIRA_BASE_URL}/browse/{issue['key']}"
-
-        start_date = fields.get("customfield_10015", "Not set")
-        due_date = fields.get("duedate", "Not set")
-        story_points = fields.get("customfield_10016", "Not set")
-        creation_date = fields.get("created", "Not Set").split("T")[0]
-        assignee = fields.get("assignee", {})
-        assignee_name = assignee.get("displayName", "Unassigned")
-        labels = fields.get("labels", [])
-        labels_str = ", ".join(labels) if labels else "None"
-        # priority = fields.get("priority", {}).get("name", "Not set")
-
-        # parent = fields.get("parent")
-        # parent_info = parent.get("key") if parent else "No parent"
-
-        mapped_username = json.loads(GITHUB_USERNAMES)
-        for user in mapped_username:
-            if user.get(assignee_name) is not None:
-                for key, value in user.items():
-                    assignee_name = value
-        user_id = get_user_node_id(assignee_name)
-
-        side_infos_dict = {
-            "Start Date": start_date,
-            "End Date": due_date,
-            "Story point": story_points,
-            "Sprint": fetched_values["sprints"],
-            "Assignees": assignee_name,
-            "Status": column,
-            "Labels": labels_str,
-        }
+    mapped_username = json.loads(GITHUB_USERNAMES)
+    for user in mapped_username:
+        if user.get(assignee_name) is not None:
+            for key, value in user.items():
+                assignee_name = value
+    user_id = get_user_node_id(assignee_name)
 
-        # Build the GitHub issue body
-        body = (
-            f"{description}\n\n"
-        )
+    side_infos_dict = {
+        "Start Date": start_date,
+        "End Date": due_date,
+        "Story point": story_points,
+        "Sprint": sprints,
+        "Assignees": assignee_name,
+        "Status": column,
+        "Labels": labels_str,
+    }
 
-        # Create label if it doesn't exist
-        create_label_if_not_exists(labels)
+    # Build the GitHub issue body
+    body = (
+        f"{description}\n\n"
+    )
 
-        # # Create the GitHub issue
-        if dict_of_infos["existing"] is False:
-            issue_node_id, issue_number = create_issue_on_board(title, body)
-            issue_id = get_github_issue(issue_number)["node_id"]
-        else:
-            gitub_issue_infos = get_linked_github_issue(dict_of_infos["id"])
-            issue_node_id = gitub_issue_infos["issue_node_id"]
-            issue_number = gitub_issue_infos["issue_number"]
-            issue_id = gitub_issue_infos["issue_id"]
-
-        items_id = get_project_details()
-        # # print(items_id)
-
-        existing_sprint, fields_name = sprint_field_is_already_existing(
-            items_id, fetched_values["sprints"], creation_date)
-        created_sprint = {}
-        if existing_sprint is False:
-            created_sprint = create_iteration_field(fields_name, creation_date)
-
-        update_infos(issue_node_id,
-                     side_infos_dict, items_id,
-                     user_id, issue_id, issue_number, created_sprint)
-        jira_infos = {
-            "id": fields.get("id"),
-            "infos": {
-                "title": title,
-                "description": description,
-                "side_infos": side_infos_dict,
-                "created_sprint": created_sprint,
-                },
-        }
-        jira_issues_infos.append(jira_infos)
+    # Create label if it doesn't exist
+    create_label_if_not_exists(labels, interactive)
 
-        infos = {
+    # # Create the GitHub issue
+    gitub_issue_infos = github_saves.get(jira_issue_id)
+    if gitub_issue_infos is None:
+        issue_node_id, issue_number = create_issue_on_board(title, body)
+        issue_id = get_github_issue(issue_number)["node_id"]
+        # Keep the link right away, a retry after a later failure must not create the issue again
+        github_saves[jira_issue_id] = {
             "title": title,
-            "linked_jira_issue_number": fields.get("id"),
-            "description": description,
+            "linked_jira_issue_number": jira_issue_id,
             "issue_node_id": issue_node_id,
             "issue_number": issue_number,
             "issue_id": issue_id,
-            "user_id": user_id,
-            "side_infos": side_infos_dict,
-            "created_sprint": created_sprint,
         }
+    else:
+        issue_node_id = gitub_issue_infos["issue_node_id"]
+        issue_number = gitub_issue_infos["issue_number"]
+        issue_id = gitub_issue_infos["issue_id"]
+
+    items_id = get_project_details()
+    # # print(items_id)
+
+    existing_sprint, fields_name = sprint_field_is_already_existing(
+        items_id, sprints, creation_date)
+    created_sprint = {}
+    if existing_sprint is False:
+        created_sprint = create_iteration_field(fields_name, creation_date)
+
+    update_infos(issue_node_id,
+                 side_infos_dict, items_id,
+                 user_id, issue_id, issue_number, created_sprint)
+    # Keep the Jira assignee so the next comparison with Jira matches
+    jira_side_infos = dict(side_infos_dict, Assignees=assignee.get("displayName", "Unassigned"))
+    jira_saves[jira_issue_id] = {
+        "id": jira_issue_id,
+        "infos": {
+            "title": title,
+            "description": description,
+            "side_infos": jira_side_infos,
+            "created_sprint": created_sprint,
+            },
+    }
+    github_saves[jira_issue_id] = {
+        "title": title,
+        "linked_jira_issue_number": jira_issue_id,
+        "description": description,
+        "issue_node_id": issue_node_id,
+        "issue_number": issue_number,
+        "issue_id": issue_id,
+        "user_id": user_id,
+        "side_infos": side_infos_dict,
+        "created_sprint": created_sprint,
+    }
+
+
+def remove_github_issues(github_infos):
+    mutations = []
+    for i, infos in enumerate(github_infos):
+        if RECONCILE_ACTION in ("archive", "both"):
+            mutations.append((f"archive{i}", "archiveProjectV2Item", "ArchiveProjectV2ItemInput",
+                              {"projectId": GITHUB_PROJECT_ID, "itemId": infos["issue_node_id"]}, "item { id }"))
+        if RECONCILE_ACTION in ("close", "both"):
+            mutations.append((f"close{i}", "closeIssue", "CloseIssueInput",
+                              {"issueId": infos["issue_id"]}, "issue { id }"))
+    if not mutations:
+        # Nothing was sent to Github, none of the issues can be forgotten
+        return set(range(len(github_infos)))
+
+    query = "mutation RemoveIssues(%s) {\n%s\n}" % (
+        ", ".join(f"${alias}: {input_type}!" for alias, _, input_type, _, _ in mutations),
+        "\n".join(f"  {alias}: {name}(input: ${alias}) {{ {selection} }}"
+                  for alias, name, _, _, selection in mutations),
+    )
+    variables = {alias: value for alias, _, _, value, _ in mutations}
+    result = run_graphql(query, variables)
+
+    # An item already removed on Github doesn't need to be removed again
+    failed = set()
+    for error in result.get("errors", []):
+        if error.get("type") == "NOT_FOUND":
+            continue
+        print(f"Failed to remove a Github issue: {error.get('message')}")
+        alias = (error.get("path") or ["all"])[0]
+        if alias == "all":
+            return set(range(len(github_infos)))
+        failed.add(int(alias.replace("archive", "").replace("close", "")))
+    return failed
+
+
+def reconcile_jira_to_github(jira_saves, github_saves, jira_issue_ids=None):
+    if jira_issue_ids is None:
+        jira_issue_ids = fetch_jira_issue_ids()
+    if not jira_issue_ids:
+        print("No Jira issue found, skipping the reconciliation")
+        return 0
+
+    # Issues saved without their Jira id can't be matched, they are fixed on the next run
+    removed_ids = [issue_id for issue_id in set(jira_saves) | set(github_saves)
+                   if issue_id is not None and issue_id not in jira_issue_ids]
+    failed_ids = set()
+    for start in range(0, len(removed_ids), RECONCILE_BATCH_SIZE):
+        batch_ids = [issue_id for issue_id in removed_ids[start:start + RECONCILE_BATCH_SIZE]
+                     if issue_id in github_saves]
+        failed = remove_github_issues([github_saves[issue_id] for issue_id in batch_ids])
+        failed_ids.update(batch_ids[i] for i in failed)
+
+    removed = 0
+    for issue_id in removed_ids:
+        if issue_id in failed_ids:
+            continue
+        jira_saves.pop(issue_id, None)
+        github_saves.pop(issue_id, None)
+        removed += 1
+    if removed:
+        print(f"Removed {removed} issue(s) deleted or moved out of the Jira project")
+    return removed
+
+
+def replicate_jira_to_github(snapshot_file=None):
+    if snapshot_file is None:
+        sprints, issues = list(iter_jira_sprints()), iter_jira_issues()
+    else:
+        sprints, issues = read_snapshot(snapshot_file)
+    jira_saves, github_saves, legacy_saves = load_saves()
 
-        saved_infos.append(infos)
+    # Each issue is replicated as soon as it is read, the whole project is never held in memory
+    try:
+        for position, issue in enumerate(issues):
+            adopt_legacy_saves(position, issue, legacy_saves, jira_saves, github_saves)
+            replicate_issue(issue, sprints, jira_saves, github_saves)
+        # Every issue was read, the older saves left over belong to removed issues
+        legacy_saves = None
+
+        # A snapshot may be older than the last run, the issues missing from it aren't removed
+        if snapshot_file is None:
+            try:
+                reconcile_jira_to_github(jira_saves, github_saves)
+            except requests.RequestException as error:
+                print(f"Failed to reconcile Jira with Github: {error}")
+    finally:
+        write_saves(jira_saves, github_saves, legacy_saves)
+
+
+def reconcile():
+    jira_saves, github_saves, legacy_saves = load_saves()
+    if reconcile_jira_to_github(jira_saves, github_saves):
+        write_saves(jira_saves, github_saves, legacy_saves)
+
+
+def parse_jira_date(value):
+    try:
+        return datetime.strptime(value, "%Y-%m-%dT%H:%M:%S.%f%z").timestamp()
+    except (TypeError, ValueError):
+        return 0
 
-    with open("jira_save.json", "w") as file:
-        json.dump(jira_issues_infos, file)
-    with open("github_save.json", "w") as file:
-        json.dump(saved_infos, file)
+
+def issue_in_active_sprint(issue):
+    for sprint in issue.get("fields", {}).get(JIRA_SPRINT_FIELD) or []:
+        if isinstance(sprint, dict):
+            if sprint.get("state") == "active":
+                return True
+        # Jira server returns the sprints as serialized strings
+        elif "state=ACTIVE" in str(sprint):
+            return True
+    return False
+
+
+def issue_priority(issue, now):
+    updated = parse_jira_date(issue.get("fields", {}).get("updated"))
+    if issue_in_active_sprint(issue):
+        rank = 0
+    elif now - updated <= DAEMON_HOT_WINDOW:
+        rank = 1
+    else:
+        rank = 2
+    # Most recently updated issues first inside a same rank
+    return rank, -updated
+
+
+def next_poll_interval(interval, changes):
+    if changes:
+        interval = max(DAEMON_MIN_INTERVAL, interval / 2)
+    else:
+        interval = min(DAEMON_MAX_INTERVAL, interval * 2)
+    return max(interval, rate_limit_wait_time())
+
+
+def stop_daemon(signum, frame):
+    # Turn a `docker stop` into a normal exit so the saves are written
+    raise SystemExit(0)
+
+
+def run_daemon():
+    signal.signal(signal.SIGTERM, stop_daemon)
+    queue = []
+    pending = {}
+    counter = itertools.count()
+    interval = DAEMON_MIN_INTERVAL
+    sprints = []
+    jira_saves = github_saves = None
+    last_poll = last_full_sync = None
+    next_poll = 0
+    unsaved_changes = False
+    last_save = time.time()
+
+    try:
+        while True:
+            now = time.time()
+            if now >= next_poll:
+                try:
+                    if last_full_sync is None or now - last_full_sync >= DAEMON_FULL_SYNC_INTERVAL:
+                        fetched_values = fetch_jira_issues()
+                        last_full_sync = now
+                        # Pick up the fields edited on the Github project meanwhile
+                        PROJECT_DETAILS_CACHE.clear()
+                    else:
+                        # Jira relative dates are in minutes, overlap a bit to not miss any update
+                        minutes = int((now - last_poll) // 60) + 2
+                        fetched_values = fetch_jira_issues(
+                            f'project={JIRA_PROJECT_NAME} AND updated >= "-{minutes}m"')
+                except Exception as error:
+                    # The sprints come from the jira client, which raises JIRAError rather than a requests error
+                    print(f"Failed to poll Jira: {error!r}")
+                    interval = next_poll_interval(interval, 0)
+                    next_poll = time.time() + interval
+                    continue
+                last_poll = now
+                sprints = fetched_values["sprints"]
+                if jira_saves is None:
+                    jira_saves, github_saves, legacy_saves = load_saves()
+                    for position, issue in enumerate(fetched_values["issues"]):
+                        adopt_legacy_saves(position, issue, legacy_saves, jira_saves, github_saves)
+                if last_full_sync == now:
+                    # A full sync lists every issue of the project, the queued ones gone since are dropped
+                    jira_issue_ids = {issue["id"] for issue in fetched_values["issues"]}
+                    for issue_id in [issue_id for issue_id in pending if issue_id not in jira_issue_ids]:
+                        del pending[issue_id]
+                    try:
+                        if reconcile_jira_to_github(jira_saves, github_saves, jira_issue_ids):
+                            unsaved_changes = True
+                    except Exception as error:
+                        print(f"Failed to reconcile Jira with Github: {error!r}")
+
+                changes = 0
+                list_of_infos = find_issue_to_update(fetched_values, jira_saves)
+                for issue, dict_of_infos in zip(fetched_values["issues"], list_of_infos):
+                    if dict_of_infos["existing"] and not dict_of_infos["modified"]:
+                        continue
+                    # A newer version of an already queued issue replaces it
+                    entry = (*issue_priority(issue, now), next(counter), issue["id"])
+                    pending[issue["id"]] = (entry, issue)
+                    heapq.heappush(queue, entry)
+                    changes += 1
+                interval = next_poll_interval(interval, changes)
+                next_poll = time.time() + interval
+                print(f"Polled Jira: {changes} issue(s) to replicate, {len(pending)} queued, "
+                      f"next poll in {interval:.0f}s")
+
+            # Save regularly, a long backlog can take hours to drain
+            if unsaved_changes and (not queue or time.time() - last_save >= DAEMON_SAVE_INTERVAL):
+                write_saves(jira_saves, github_saves)
+                unsaved_changes = False
+                last_save = time.time()
+
+            if not queue:
+                time.sleep(max(0, next_poll - time.time()))
+                continue
+
+            wait_time = rate_limit_wait_time()
+            if wait_time:
+                print(f"GitHub rate limit almost reached, waiting {wait_time:.0f}s")
+                time.sleep(wait_time)
+                continue
+
+            entry = heapq.heappop(queue)
+            if pending.get(entry[-1], (None,))[0] != entry:
+                continue
+            entry, issue = pending.pop(entry[-1])
+            try:
+                replicate_issue(issue, sprints, jira_saves, github_saves, interactive=False)
+            except Exception as error:
+                # One bad issue must not stop the daemon, the next full sync picks it up again
+                print(f"Failed to replicate Jira issue {issue['id']}: {error!r}")
+            # A failed issue may still have been created on Github
+            unsaved_changes = True
+    finally:
+        if unsaved_changes:
+            write_saves(jira_saves, github_saves)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replicate Jira tickets to a Github project.")
+    parser.add_argument(
+        "command", nargs="?", default="run", choices=["run", "daemon", "reconcile", "snapshot"],
+        help="run: replicate once (default), daemon: keep replicating as Jira changes, "
+             "reconcile: only remove the issues deleted or moved out of the Jira project, "
+             "snapshot: save the Jira issues and sprints to a file")
+    parser.add_argument(
+        "--from-snapshot", metavar="FILE",
+        help="run: replicate the issues of a snapshot instead of fetching them from Jira")
+    parser.add_argument(
+        "--output", metavar="FILE", default=SNAPSHOT_FILE,
+        help=f"snapshot: file to write the snapshot to (default: {SNAPSHOT_FILE})")
+    args = parser.parse_args()
+    if RECONCILE_ACTION not in RECONCILE_ACTIONS:
+        parser.error(f"RECONCILE_ACTION must be one of {', '.join(RECONCILE_ACTIONS)}, not '{RECONCILE_ACTION}'")
+    if args.from_snapshot and args.command != "run":
+        parser.error("--from-snapshot can only be used with the run command")
+
+    if args.command == "daemon":
+        run_daemon()
+    elif args.command == "reconcile":
+        reconcile()
+    elif args.command == "snapshot":
+        write_snapshot(args.output)
+    else:
+        replicate_jira_to_github(args.from_snapshot)
 
 
 if __name__ == "__main__":
-    replicate_jira_to_github()
+    main()